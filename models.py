@@ -1,5 +1,7 @@
 from itertools import cycle, islice
+import os
 
+import numpy as np
 import tensorflow as tf
 
 
@@ -18,6 +20,9 @@ class FullyConnectedWTA:
                  optimizer=tf.train.AdamOptimizer,
                  learning_rate=1e-2,
                  tie_weights=True,
+                 approximate_top_k=False,
+                 sparse_decode=False,
+                 dtype=tf.float32,
                  weight_initializer=tf.random_normal_initializer(0, 0.01, seed=1),
                  bias_initializer=tf.constant_initializer(0.01),
                  name='FCWTA'):
@@ -34,6 +39,23 @@ class FullyConnectedWTA:
           learning_rate: the learning rate to train with.
           tie_weights: whether to use the same weight matrix for the decode
             layer and final encode layer.
+          approximate_top_k: whether to enforce the sparsity constraint with a
+            per-neuron threshold estimated from every other example of the
+            batch, rather than an exact top k selection over the whole batch.
+            The estimate still depends on how examples are spread over the
+            batch, and all activations tied with the threshold are kept, so a
+            neuron may keep more (or fewer) than k activations. Requires a
+            batch_size of at least 2, and sparsity * batch_size of at least 1
+            (the exact top k selection instead keeps nothing when
+            int(sparsity * batch_size) is 0).
+          sparse_decode: whether to feed the top k activations to the decode
+            layer as a tf.SparseTensor. This saves FLOPs only at low sparsity
+            (e.g. 0.05), and is ignored if approximate_top_k is set.
+          dtype: the floating point type to compute the encode and decode
+            layers in, e.g. tf.bfloat16 or tf.float16. Variables, the loss,
+            the dictionary and all outputs are kept in float32. tf.bfloat16
+            cannot be combined with sparse_decode (unless approximate_top_k is
+            set, in which case sparse_decode is ignored).
           weight_initializer: initializer to use for matrices of weights.
           bias_initializer: initializer to use for matrices of biases.
           name: the name of the variable scope to use.
@@ -46,9 +68,28 @@ class FullyConnectedWTA:
         self.optimizer = optimizer
         self.learning_rate = learning_rate
         self.tie_weights = tie_weights
+        self.approximate_top_k = approximate_top_k
+        self.sparse_decode = sparse_decode
+        self.dtype = dtype
         self.weight_initializer = weight_initializer
         self.bias_initializer = bias_initializer
         self.name = name
+
+        if approximate_top_k and batch_size < 2:
+            raise ValueError('approximate_top_k requires a batch_size of at '
+                             'least 2, got {}.'.format(batch_size))
+        if approximate_top_k and int(sparsity * batch_size) == 0:
+            raise ValueError('approximate_top_k requires sparsity * batch_size '
+                             'to be at least 1, got {} * {}.'.format(
+                                sparsity, batch_size))
+
+        if sparse_decode and not approximate_top_k and dtype == tf.bfloat16:
+            raise ValueError('sparse_decode does not support dtype bfloat16, '
+                             'which tf.sparse_tensor_dense_matmul does not '
+                             'implement.')
+
+        self._callables_session = None
+        self._callables = {}
         self._initialize_vars()
 
     def _initialize_vars(self):
@@ -58,70 +99,140 @@ class FullyConnectedWTA:
                 'global_step',
                 shape=[],
                 initializer=tf.zeros_initializer())
-            self.input = tf.placeholder(tf.float32, shape=[None, self.input_dim])
+            self.input = tf.placeholder(tf.float32, shape=[None, self.input_dim],
+                                        name='input')
 
-        current = self.input
+        current = tf.cast(self.input, self.dtype)
         for i in range(self.encode_layers - 1):
             current = self._relu_layer(current, self.input_dim, self.input_dim, i)
-        self.encoded = self._relu_layer(current, self.input_dim, self.hidden_units, self.encode_layers - 1)
-
-        # Make batch size the last dimension (for use with tf.nn.top_k)
-        encoded_t = tf.transpose(self.encoded)
-
-        # Compute the indices corresponding to the top k activations for each
-        # neuron in the final encoder layer
-        k = int(self.sparsity * self.batch_size)
-        _, top_indices = tf.nn.top_k(encoded_t, k=k, sorted=False)
 
-        # Transform top_indices, which contains rows of column indices, into
-        # indices, a list of [row, column] pairs (for use with tf.scatter_nd)
-        top_k_unstacked = tf.unstack(top_indices, axis=1)
-        row_indices = [tf.range(self.hidden_units) for _ in range(k)]
-        combined_columns = tf.transpose(tf.stack(_interleave(row_indices, top_k_unstacked)))
-        indices = tf.reshape(combined_columns, [-1, 2])
+        encoded = self._relu_layer(current, self.input_dim, self.hidden_units,
+                                   self.encode_layers - 1)
+        self.encoded = tf.cast(encoded, tf.float32)
 
-        # Apply sparsity constraint
-        updates = tf.ones(self.hidden_units * k)
-        shape = tf.constant([self.hidden_units, self.batch_size])
-        mask = tf.scatter_nd(indices, updates, shape)
-        sparse_encoded = self.encoded * tf.transpose(mask)
+        # Make batch size the last dimension (for use with tf.nn.top_k). The
+        # final encode layer could instead be computed directly in this layout
+        # (W^T input^T + b), saving this transpose, but its bias would then be
+        # per-row and could not be fused as a BiasAdd into _FusedMatMul; with
+        # encode_layers=1 that would leave no encode layer fusable. The sparse
+        # activations are built straight in [batch, neuron] layout, so this is
+        # the only transpose
+        encoded_t = tf.transpose(encoded)
 
-        self.decoded = self._decode_layer(sparse_encoded)
-
-        self.loss = tf.reduce_sum(tf.square(self.decoded - self.input))
+        k = int(self.sparsity * self.batch_size)
+        if self.approximate_top_k:
+            # Estimate the k-th largest activation of each neuron from every
+            # other example (so the sample spans the whole batch), and keep
+            # every activation at or above it
+            sample_values, _ = tf.nn.top_k(encoded_t[:, ::2],
+                                           k=max(k // 2, 1), sorted=False)
+            threshold = tf.reduce_min(sample_values, axis=1, keepdims=True)
+            sparse_encoded = tf.where(encoded >= tf.transpose(threshold), encoded,
+                                      tf.zeros_like(encoded))
+        else:
+            # Compute the top k activations (and their indices) for each neuron
+            # in the final encoder layer
+            top_values, top_indices = tf.nn.top_k(encoded_t, k=k, sorted=False)
+            top_values = tf.reshape(top_values, [-1])
+
+            # Transform top_indices, which contains rows of batch indices, into
+            # indices, a list of [batch, neuron] pairs. Keep these int32, like
+            # top_indices, to halve the index buffer, and out of the backward
+            # pass: gradients flow only through the values
+            row_indices = tf.constant(
+                np.tile(np.arange(self.hidden_units)[:, np.newaxis], [1, k]),
+                dtype=tf.int32)
+            indices = tf.stop_gradient(
+                tf.reshape(tf.stack([top_indices, row_indices], axis=-1), [-1, 2]))
+
+            if self.sparse_decode:
+                # Apply sparsity constraint by keeping only the top k activations,
+                # as a [batch_size, hidden_units] SparseTensor (which requires
+                # int64 indices)
+                sparse_encoded = tf.SparseTensor(tf.cast(indices, tf.int64), top_values,
+                                                 [self.batch_size, self.hidden_units])
+            else:
+                # Apply sparsity constraint by scattering the top k activations
+                # into an otherwise zero tensor
+                shape = tf.constant([self.batch_size, self.hidden_units], dtype=tf.int32)
+                sparse_encoded = tf.scatter_nd(indices, top_values, shape)
+
+        self.sparse_encoded = sparse_encoded
+        self.decoded = tf.cast(self._decode_layer(sparse_encoded), tf.float32)
+
+        # Decoding a (scaled) identity matrix approximately recovers the code
+        # dictionary; build this once so get_dictionary adds no new ops. This is
+        # always done in float32, since 1e15 overflows e.g. float16
+        self.dictionary = self._decode_layer(
+            tf.constant(1e15 * np.eye(self.hidden_units), dtype=tf.float32),
+            reuse=True, dtype=tf.float32)
+
+        self.loss = tf.reduce_sum(tf.squared_difference(self.decoded, self.input))
         self.optimizer_op = self.optimizer(self.learning_rate).minimize(
             self.loss, self.global_step)
 
-        self.saver = tf.train.Saver(tf.global_variables())
+        # saver checkpoints only the model weights and global step, which is
+        # all that inference needs; training_saver also checkpoints the
+        # optimizer's variables (e.g. Adam moments), for resuming training
+        self.saver = tf.train.Saver(self._get_model_variables() + [self.global_step])
+        self.training_saver = tf.train.Saver(tf.global_variables())
 
     def _relu_layer(self, input, input_dim, output_dim, layer_num):
         with tf.variable_scope(self.name) as scope:
-            return tf.nn.relu_layer(
-                input,
+            encode_W = tf.cast(
                 tf.get_variable('encode_W_{}'.format(layer_num),
                                 shape=[input_dim, output_dim],
                                 initializer=self.weight_initializer),
+                self.dtype)
+            encode_b = tf.cast(
                 tf.get_variable('encode_b_{}'.format(layer_num),
                                 shape=[output_dim],
                                 initializer=self.bias_initializer),
+                self.dtype)
+            # Spell out MatMul + BiasAdd + Relu so that Grappler's remapper can
+            # fuse them into a single _FusedMatMul op; every encode layer,
+            # including the final one, goes through here
+            return tf.nn.relu(
+                tf.nn.bias_add(tf.matmul(input, encode_W), encode_b),
                 'encode_layer_{}'.format(layer_num))
 
-    def _decode_layer(self, input, reuse=False):
+    def _decode_layer(self, input, reuse=False, dtype=None):
+        dtype = dtype or self.dtype
         with tf.variable_scope(self.name, reuse=reuse) as scope:
-            decode_b = tf.get_variable('decode_b',
-                                       shape=[self.input_dim],
-                                       initializer=self.bias_initializer)
+            decode_b = tf.cast(
+                tf.get_variable('decode_b',
+                                shape=[self.input_dim],
+                                initializer=self.bias_initializer),
+                dtype)
             if self.tie_weights:
                 scope.reuse_variables()
-                decode_W = tf.transpose(tf.get_variable(
+                # Let the matmul read the encode weights transposed rather than
+                # materializing their transpose
+                decode_W = tf.cast(tf.get_variable(
                     self._get_last_encode_layer_name(),
-                    shape=[self.input_dim, self.hidden_units]))
+                    shape=[self.input_dim, self.hidden_units]), dtype)
             else:
-                decode_W = tf.get_variable(
+                decode_W = tf.cast(tf.get_variable(
                     'decode_W',
                     shape=[self.hidden_units, self.input_dim],
-                    initializer=self.weight_initializer)
-            return tf.matmul(input, decode_W) + decode_b
+                    initializer=self.weight_initializer), dtype)
+            if isinstance(input, tf.SparseTensor):
+                decoded = tf.sparse_tensor_dense_matmul(input, decode_W,
+                                                        adjoint_b=self.tie_weights)
+            else:
+                decoded = tf.matmul(input, decode_W, transpose_b=self.tie_weights)
+            return tf.nn.bias_add(decoded, decode_b)
+
+    def _get_model_variables(self):
+        """Returns the weight and bias variables of the encode/decode layers."""
+        names = []
+        for i in range(self.encode_layers):
+            names += ['encode_W_{}'.format(i), 'encode_b_{}'.format(i)]
+        names.append('decode_b')
+        if not self.tie_weights:
+            names.append('decode_W')
+        with tf.variable_scope(self.name, reuse=True):
+            return [tf.get_variable(name) for name in names]
 
     def _get_last_encode_layer_name(self):
         return 'encode_W_{}'.format(self.encode_layers - 1)
@@ -151,14 +262,13 @@ class FullyConnectedWTA:
                              'provided in the constructor, {} != {}.'.format(
                                 input.shape[1], self.input_dim))
 
+        input = np.asarray(input, dtype=np.float32)
         if forward_only:
-            decoded, loss = session.run(
-                [self.decoded, self.loss],
-                feed_dict={self.input: input})
+            decoded, loss = self._get_callable(
+                session, 'forward', [self.decoded, self.loss])(input)
         else:
-            decoded, loss, _ = session.run(
-                [self.decoded, self.loss, self.optimizer_op],
-                feed_dict={self.input: input})
+            decoded, loss, _ = self._get_callable(
+                session, 'train', [self.decoded, self.loss, self.optimizer_op])(input)
         return decoded, loss
 
     def encode(self, session, input):
@@ -179,7 +289,23 @@ class FullyConnectedWTA:
             raise ValueError('Dimensionality of input must equal the input_dim'
                              'provided in the constructor, {} != {}.'.format(
                                 input.shape[1], self.input_dim))
-        return session.run(self.encoded, feed_dict={self.input: input})
+        return self._get_callable(session, 'encode', self.encoded)(
+            np.asarray(input, dtype=np.float32))
+
+    def _get_callable(self, session, name, fetches):
+        """Returns a callable running fetches on a float32 input array.
+
+        Callables are cached for the most recently used session only; they
+        reference that session, so it is kept alive until the model is used
+        with another session (which drops the cache) or is itself deleted.
+        """
+        if session is not self._callables_session:
+            self._callables_session = session
+            self._callables = {}
+        if name not in self._callables:
+            self._callables[name] = session.make_callable(
+                fetches, feed_list=[self.input])
+        return self._callables[name]
 
     def get_dictionary(self, session):
         """Fetch (approximately) the learned code dictionary.
@@ -190,10 +316,67 @@ class FullyConnectedWTA:
         Returns:
           The code dictionary, with shape (hidden_units, input_dim).
         """
-        fake_input = 1e15 * tf.eye(self.hidden_units)
-        return session.run(self._decode_layer(fake_input, reuse=True))
+        return session.run(self.dictionary)
+
+    def freeze(self, session):
+        """Freeze the inference graph, with the current weights as constants.
+
+        Constant weights can be packed into a blocked layout once (by oneDNN or
+        XLA) rather than reordered on every run.
+
+        Args:
+          session: TensorFlow session to use.
+
+        Returns:
+          A GraphDef computing encoded and decoded from input.
+        """
+        return tf.graph_util.convert_variables_to_constants(
+            session,
+            session.graph.as_graph_def(),
+            [self.encoded.op.name, self.decoded.op.name])
 
+    def export_aot(self, session, directory):
+        """Write the frozen inference graph and a tfcompile config for it.
 
-def _interleave(xs, ys):
-    """Interleaves the two given lists (assumed to be of equal length)."""
-    return [val for pair in zip(xs, ys) for val in pair]
+        All shapes (batch_size, input_dim, hidden_units and k) are baked into
+        the graph, so it can be compiled ahead of time into a specialized
+        kernel, e.g. with
+
+          tfcompile --graph=frozen.pb --config=tfcompile.config.pbtxt \\
+              --cpp_class=FCWTAInference
+
+        Args:
+          session: TensorFlow session to use.
+          directory: the directory to write frozen.pb and
+            tfcompile.config.pbtxt to.
+
+        Raises:
+          ValueError: if the model was constructed with sparse_decode (and
+          without approximate_top_k), whose SparseTensorDenseMatMul op
+          tfcompile cannot lower.
+        """
+        if self.sparse_decode and not self.approximate_top_k:
+            raise ValueError('export_aot does not support sparse_decode, since '
+                             'tfcompile cannot lower SparseTensorDenseMatMul.')
+
+        # tf2xla_pb2 is not shipped by every TF1 build, so only require it here
+        from google.protobuf import text_format
+        from tensorflow.compiler.tf2xla import tf2xla_pb2
+
+        tf.train.write_graph(self.freeze(session), directory, 'frozen.pb',
+                             as_text=False)
+
+        config = tf2xla_pb2.Config()
+        feed = config.feed.add()
+        feed.id.node_name = self.input.op.name
+        feed.id.output_index = self.input.value_index
+        feed.shape.dim.add().size = self.batch_size
+        feed.shape.dim.add().size = self.input_dim
+        feed.name = 'input'
+        for tensor, name in [(self.encoded, 'encoded'), (self.decoded, 'decoded')]:
+            fetch = config.fetch.add()
+            fetch.id.node_name = tensor.op.name
+            fetch.id.output_index = tensor.value_index
+            fetch.name = name
+        with tf.gfile.GFile(os.path.join(directory, 'tfcompile.config.pbtxt'), 'w') as f:
+            f.write(text_format.MessageToString(config))
@@ -0,0 +1,136 @@
+"""
+Tests for models.py.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from models import FullyConnectedWTA
+
+
+class SparseDecodeTest(tf.test.TestCase):
+    """Checks that sparse_decode matches the dense (scatter) decode path."""
+
+    def _run(self, input, tie_weights, sparse_decode):
+        """Returns decoded, loss and loss gradients from a freshly built model."""
+        with tf.Graph().as_default():
+            fcwta = FullyConnectedWTA(input.shape[1],
+                                      input.shape[0],
+                                      sparsity=0.25,
+                                      hidden_units=4,
+                                      encode_layers=2,
+                                      tie_weights=tie_weights,
+                                      sparse_decode=sparse_decode)
+            variables = sorted(tf.trainable_variables(), key=lambda v: v.name)
+            gradients = [g for g in tf.gradients(fcwta.loss, variables)
+                         if g is not None]
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                return sess.run([fcwta.decoded, fcwta.loss, gradients],
+                                feed_dict={fcwta.input: input})
+
+    def _check_equivalent(self, tie_weights):
+        input = np.random.RandomState(0).rand(20, 6).astype(np.float32)
+        dense = self._run(input, tie_weights, sparse_decode=False)
+        sparse = self._run(input, tie_weights, sparse_decode=True)
+        self.assertAllClose(dense[0], sparse[0])
+        self.assertAllClose(dense[1], sparse[1])
+        self.assertEqual(len(dense[2]), len(sparse[2]))
+        for dense_gradient, sparse_gradient in zip(dense[2], sparse[2]):
+            self.assertAllClose(dense_gradient, sparse_gradient)
+
+    def testTiedWeights(self):
+        self._check_equivalent(tie_weights=True)
+
+    def testUntiedWeights(self):
+        self._check_equivalent(tie_weights=False)
+
+
+class ApproximateTopKTest(tf.test.TestCase):
+    """Checks the approximate_top_k sparsity constraint."""
+
+    def testRejectsBatchSizeBelowTwo(self):
+        with tf.Graph().as_default():
+            with self.assertRaises(ValueError):
+                FullyConnectedWTA(6, 1, sparsity=1.0, approximate_top_k=True)
+
+    def testRejectsZeroK(self):
+        with tf.Graph().as_default():
+            with self.assertRaises(ValueError):
+                FullyConnectedWTA(6, 10, sparsity=0.05, approximate_top_k=True)
+
+    def testKeepsRoughlyKPerNeuron(self):
+        batch_size, sparsity = 200, 0.1
+        k = int(sparsity * batch_size)
+        input = np.random.RandomState(0).rand(batch_size, 6).astype(np.float32)
+        with tf.Graph().as_default():
+            fcwta = FullyConnectedWTA(6,
+                                      batch_size,
+                                      sparsity=sparsity,
+                                      hidden_units=4,
+                                      encode_layers=2,
+                                      approximate_top_k=True)
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                sparse_encoded = sess.run(fcwta.sparse_encoded,
+                                          feed_dict={fcwta.input: input})
+        kept = np.count_nonzero(sparse_encoded, axis=0)
+        self.assertEqual(kept.shape, (4,))
+        self.assertTrue(np.all(kept >= k // 2), kept)
+        self.assertTrue(np.all(kept <= 2 * k), kept)
+
+
+class Float16Test(tf.test.TestCase):
+    """Checks that the model works when computing in float16."""
+
+    def testDictionaryAndStep(self):
+        input = np.random.RandomState(0).rand(20, 6).astype(np.float32)
+        with tf.Graph().as_default():
+            fcwta = FullyConnectedWTA(6,
+                                      20,
+                                      sparsity=0.25,
+                                      hidden_units=4,
+                                      dtype=tf.float16)
+            with self.test_session(use_gpu=False) as sess:
+                sess.run(tf.global_variables_initializer())
+                dictionary = fcwta.get_dictionary(sess)
+                decoded, loss = fcwta.step(sess, input)
+        self.assertEqual(dictionary.shape, (4, 6))
+        self.assertTrue(np.all(np.isfinite(dictionary)))
+        self.assertEqual(decoded.shape, (20, 6))
+        self.assertEqual(np.asarray(loss).dtype, np.float32)
+        self.assertTrue(np.isfinite(loss))
+
+    def testBfloat16AllowedWithApproximateTopK(self):
+        with tf.Graph().as_default():
+            FullyConnectedWTA(6, 20, sparsity=0.25, approximate_top_k=True,
+                              sparse_decode=True, dtype=tf.bfloat16)
+
+    def testBfloat16RejectedWithSparseDecode(self):
+        with tf.Graph().as_default():
+            with self.assertRaises(ValueError):
+                FullyConnectedWTA(6, 20, sparsity=0.25, sparse_decode=True,
+                                  dtype=tf.bfloat16)
+
+
+class SaverTest(tf.test.TestCase):
+    """Checks the variables covered by saver and training_saver."""
+
+    def testInsideEnclosingScope(self):
+        with tf.Graph().as_default():
+            with tf.variable_scope('outer'):
+                fcwta = FullyConnectedWTA(6, 20, sparsity=0.25, hidden_units=4,
+                                          encode_layers=2, tie_weights=False)
+            saved = set(v.name for v in fcwta.saver._var_list)
+            expected = set('outer/FCWTA/{}:0'.format(name) for name in
+                           ['encode_W_0', 'encode_b_0', 'encode_W_1', 'encode_b_1',
+                            'decode_W', 'decode_b', 'global_step'])
+            self.assertEqual(saved, expected)
+            self.assertIn(fcwta.global_step.name, saved)
+            self.assertFalse([name for name in saved if '/Adam' in name])
+            self.assertEqual(set(fcwta.training_saver._var_list),
+                             set(tf.global_variables()))
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -10,6 +10,7 @@ import sklearn.manifold
 from sklearn.metrics import confusion_matrix, accuracy_score
 import sklearn.svm
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 
 def timestamp(format='%Y_%m_%d_%H_%M_%S'):
@@ -17,6 +18,28 @@ def timestamp(format='%Y_%m_%d_%H_%M_%S'):
     return datetime.datetime.now().strftime(format)
 
 
+def session_config(jit=False):
+    """Returns a tf.ConfigProto with the graph optimizations used for training.
+
+    Grappler's constant folding and remapper passes are on by default; they
+    are pinned on here so that MatMul + BiasAdd (+ Relu) fusion does not
+    depend on that default.
+
+    If jit is set, XLA auto-clustering is turned on so that chains of small
+    ops (e.g. sparsity, decode and loss) are compiled into fused kernels. On
+    CPU this only takes effect if TF_XLA_FLAGS=--tf_xla_cpu_global_jit is set
+    in the environment; otherwise it is a no-op there.
+    """
+    config = tf.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+    if jit:
+        config.graph_options.optimizer_options.global_jit_level = (
+            tf.OptimizerOptions.ON_1)
+    return config
+
+
 def plot_dictionary(dictionary, shape, num_shown=20, row_length=10):
     """Plots the code dictionary."""
     rows = num_shown / row_length